@@ -18,6 +18,9 @@ model_parser.add_argument('--transformer',  default='bert',     type=str,  help=
 model_parser.add_argument('--max_len',      default=512,        type=int,  help='max length of transformer inputs')
 model_parser.add_argument('--device',       default='cuda',     type=str,  help='device to use [cuda, cpu]')
 model_parser.add_argument('--num_classes',  default=2,        type=int,  help='number of unique label classes')
+model_parser.add_argument('--eval_bsz',     default=32,         type=int,  help='batch size used for evaluation')
+model_parser.add_argument('--amp',          action='store_true',  help='if set, uses mixed precision (bf16 where supported)')
+model_parser.add_argument('--compile',      action='store_true',  help='if set, compiles the model with torch.compile')
 
 model_parser.add_argument('--num_seeds',  default=1,            type=int,  help='number of seeds to train')
 model_parser.add_argument('--force',      action='store_true',  help='if set, will overwrite any existing directory')
@@ -32,6 +35,7 @@ train_parser.add_argument('--print_len', default=100,     type=int,  help='loggi
 train_parser.add_argument('--epochs',  default=50,    type=int,     help='numer of epochs to train')
 train_parser.add_argument('--lr',      default=1e-5,  type=float,   help='training learning rate')
 train_parser.add_argument('--bsz',     default=8,     type=int,     help='training batch size')
+train_parser.add_argument('--accum_steps', default=1, type=int, help='number of batches to accumulate gradients over per update')
 
 train_parser.add_argument('--optim',   default='adamw', type=str,  help='[adam, adamw, sgd]')
 train_parser.add_argument('--wandb',   default=None,    type=str,  help='experiment name to use for wandb (and to enable)')
@@ -1,3 +1,3 @@
 from .data_loader import DataLoader
 from .dir_helper  import DirHelper
-from .batcher     import Batcher
\ No newline at end of file
+from .batcher     import Batcher, BackgroundGenerator
\ No newline at end of file
@@ -1,28 +1,53 @@
 import torch
 import random
+import threading
+import queue
 
 from itertools import islice
-from typing import List
+from typing import List, Callable
 from types import SimpleNamespace
 
 class Batcher:
-    def __init__(self, max_len:int):
-        self.device     = torch.device('cpu')
-        self.max_len    = max_len
+    def __init__(self, max_len:int, pad_multiple:int=None):
+        self.device       = torch.device('cpu')
+        self.max_len      = max_len
+        self.pad_multiple = pad_multiple
+        self.stream       = None
 
-    def batches(self, data:list, bsz:int, shuffle:bool=False):
+    def batches(self, data:list, bsz:int, shuffle:bool=False, sort:bool=False):
         """splits the data into batches and returns them"""
+        # copies for the next batch are issued before the current one is yielded
+        prev = None
+        for item in self._copied_batches(data, bsz, shuffle, sort):
+            if prev is not None:
+                yield self._wait_for_copy(*prev)
+            prev = item
+        if prev is not None:
+            yield self._wait_for_copy(*prev)
+
+    def prefetch(self, data:list, bsz:int, shuffle:bool=False, sort:bool=False, 
+                 max_prefetch:int=4)->'BackgroundGenerator':
+        """batches prepared in a background thread, only waited on when consumed"""
+        return BackgroundGenerator(self._copied_batches(data, bsz, shuffle, sort), 
+                                   max_prefetch=max_prefetch, 
+                                   process=lambda item: self._wait_for_copy(*item))
+
+    def _copied_batches(self, data:list, bsz:int, shuffle:bool=False, sort:bool=False):
+        """yields each batch with the event marking the end of its device copies"""
         examples = self._prep_examples(data)
         if shuffle: random.shuffle(examples)
+        if sort: examples.sort(key=lambda ex: len(ex[1]))  # group similar lengths to reduce padding
         batches = [examples[i:i+bsz] for i in range(0,len(examples), bsz)]
         for batch in batches:
-            yield self.batchify(batch)
+            batch = self.batchify(batch)
+            event = self.stream.record_event() if self.stream else None
+            yield batch, event
   
     def batchify(self, batch:List[list]):
         """each input is input ids and mask for utt, + label"""
         sample_id, ids, labels = zip(*batch)  
         ids, mask = self._get_padded_ids(ids)
-        labels = torch.LongTensor(labels).to(self.device)
+        labels = self._to_device(torch.LongTensor(labels))
         return SimpleNamespace(sample_id=sample_id, ids=ids, mask=mask, labels=labels)
 
     def _prep_examples(self, data:list):
@@ -40,17 +65,102 @@ class Batcher:
                 
     def to(self, device:torch.device):
         """ sets the device of the batcher """
-        self.device = device
+        self.device = torch.device(device)
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device=self.device)
+        else:
+            self.stream = None
+
+    def _to_device(self, x:torch.Tensor)->torch.Tensor:
+        """ moves tensor to device, asynchronously via pinned memory on cuda """
+        if self.stream is None:
+            return x.to(self.device)
+        with torch.cuda.stream(self.stream):
+            return x.pin_memory().to(self.device, non_blocking=True)
+
+    def _wait_for_copy(self, batch:SimpleNamespace, event:'torch.cuda.Event')->SimpleNamespace:
+        """ makes the compute stream wait for the batch's copies before use """
+        if event is None:
+            return batch
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(event)
+        for x in (batch.ids, batch.mask, batch.labels):
+            x.record_stream(compute_stream)
+        return batch
     
-    def __call__(self, data, bsz, shuffle=False):
+    def __call__(self, data, bsz, shuffle=False, sort=False):
         """routes the main method do the batches function"""
-        return self.batches(data=data, bsz=bsz, shuffle=shuffle)
+        return self.batches(data=data, bsz=bsz, shuffle=shuffle, sort=sort)
     
     def _get_padded_ids(self, ids:list, pad_id=0)->("pad_ids", "pad_mask"):
         """ pads ids to be flat """
         max_len = max([len(x) for x in ids])
+        if self.pad_multiple:  # round up to fixed buckets so that shapes repeat across batches
+            max_len = min(-(-max_len//self.pad_multiple)*self.pad_multiple, self.max_len)
         padded_ids = [x + [pad_id]*(max_len-len(x)) for x in ids]
         mask = [[1]*len(x) + [0]*(max_len-len(x)) for x in ids]
-        ids = torch.LongTensor(padded_ids).to(self.device)
-        mask = torch.FloatTensor(mask).to(self.device)
+        ids = self._to_device(torch.LongTensor(padded_ids))
+        mask = self._to_device(torch.FloatTensor(mask))
         return ids, mask
+
+
+class BackgroundGenerator(threading.Thread):
+    """ runs a generator in a background thread so that the next items
+        are prepared while the current one is being consumed. process is 
+        applied to each item in the consuming thread. Use as a context manager
+        (or call close) so the thread stops if the consumer exits early """
+    def __init__(self, generator, max_prefetch:int=4, process:Callable=None):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(max_prefetch)
+        self.generator = generator
+        self.process = process
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        try:
+            for item in self.generator:
+                if not self._put((item, None)): return
+            self._put((StopIteration, None))
+        except Exception as e:
+            self._put((None, e))
+
+    def _put(self, item)->bool:
+        """puts item on the queue, returns False if the consumer has stopped"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        """stops the producer and drops any prefetched items"""
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.join()
+
+    def __del__(self):
+        self.stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item, error = self.queue.get()
+        if error is not None:
+            raise error
+        if item is StopIteration:
+            raise StopIteration
+        return self.process(item) if self.process else item
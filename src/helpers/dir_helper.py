@@ -60,18 +60,21 @@ class DirHelper():
     
     def reset_metrics(self):
         self.metrics = OrderedDict()
-        self.acc = np.zeros(2)
+        self.acc = [0, 0]
         self.preds, self.labels = [], []
         self.samples = 0
 
-    def update_avg_metrics(self, **kwargs):
+    def update_avg_metrics(self, n:int=1, **kwargs):
+        """adds metrics averaged over n samples (e.g. a batch mean)"""
         for key, val in kwargs.items():
             if key not in self.metrics: self.metrics[key]=0
-            self.metrics[key] += val
-        self.samples += 1
+            self.metrics[key] += val*n
+        self.samples += n
    
-    def update_acc_metrics(self, hits:int=0, num_preds:int=0):
-        self.acc += [hits, num_preds]
+    def update_acc_metrics(self, hits=0, num_preds=0):
+        # hits and num_preds may be ints or device tensors, only synced when printed
+        self.acc[0] += hits
+        self.acc[1] += num_preds
     
     def update_preds(self, y:int, label:int):
         self.preds.append(y)
@@ -79,8 +82,9 @@ class DirHelper():
         
     def print_perf(self, mode:str, epoch:int, step:int):
         """returns and logs performance"""
-        metrics = OrderedDict([(k, v/self.samples) for k, v in self.metrics.items()])
-        acc  = f'{self.acc[0]/self.acc[1]:.3f}' if self.acc[0]>0 else 0
+        metrics = OrderedDict([(k, float(v)/self.samples) for k, v in self.metrics.items()])
+        hits, num_preds = [float(x) for x in self.acc]
+        acc  = f'{hits/num_preds:.3f}' if hits>0 else 0
         metrics_str = [f'{k} {v:6.3f}' for k, v in metrics.items()]
 
         # logging performance
@@ -92,7 +96,7 @@ class DirHelper():
         return SimpleNamespace(acc=float(acc), **metrics)
     
     def print_reg_perf(self, mode:str, epoch:int, step:int):
-        metrics = OrderedDict([(k, v/self.samples) for k, v in self.metrics.items()])
+        metrics = OrderedDict([(k, float(v)/self.samples) for k, v in self.metrics.items()])
         metrics['RMSE']  = metrics['loss']**0.5
         metrics['pear']  = pearsonr(self.preds, self.labels)[0]
         metrics['spear'] = spearmanr(self.preds, self.labels)[0]
@@ -114,7 +118,7 @@ class DirHelper():
     def probs_exists(self, data_name:str, mode:str, dir_name='preds')->bool:
         eval_name = f'{data_name}_{mode}'
         pred_path = f'{self.abs_path}/{dir_name}/{eval_name}'
-        return os.path.isfile(pred_path) 
+        return os.path.isfile(f'{pred_path}.npz') or os.path.isfile(pred_path) 
 
     def save_args(self, name:str, data:namedtuple):
         """saves arguments into json format"""
@@ -125,13 +129,18 @@ class DirHelper():
         save_path = f'{self.abs_path}/{name}'
         save_json(data, save_path)
 
-    def save_probs(self, preds, data_name, mode, dir_name='preds'):
-        """saves predictions directory"""
+    def save_probs(self, preds, data_name, mode, dir_name='preds', logits:bool=False):
+        """saves predictions as a single [N, C] array with its ids, stored as
+           float16 'logits' if softmax wasn't applied, else float32 'probs'"""
         eval_name = f'{data_name}_{mode}'
         pred_path = f'{self.abs_path}/{dir_name}/{eval_name}'
         
-        with open(pred_path, 'wb') as handle:
-            pickle.dump(preds, handle)
+        # float16 would collapse confident probabilities near 1 (which OOD scores rely on)
+        dtype = np.float16 if logits else np.float32
+        ids = np.array(list(preds.keys()))
+        probs = np.array(list(preds.values()), dtype=dtype)
+        key = 'logits' if logits else 'probs'
+        np.savez(f'{pred_path}.npz', ids=ids, **{key:probs})
     
     def make_dir(self, dir_name:str):
         if not os.path.isdir(f'{self.abs_path}/{dir_name}'): 
@@ -155,11 +164,30 @@ class DirHelper():
     def load_dict(self, name:str)->dict:
         return load_json(f'{self.abs_path}/{name}')
     
-    def load_probs(self, data_name:str, mode:str, dir_name='preds'):
-        """saves predictions directory"""
+    def load_probs(self, data_name:str, mode:str, dir_name='preds', return_probs:bool=True)->dict:
+        """loads predictions as a dict of ids to rows of the saved array"""
+        ids, probs = self.load_probs_array(data_name, mode, dir_name, return_probs)
+        return dict(zip(ids.tolist(), probs))
+
+    def load_probs_array(self, data_name:str, mode:str, dir_name='preds', return_probs:bool=True):
+        """loads predictions as the ids and the [N, C] probability array. If
+           return_probs is False, saved logits are returned as they are"""
         eval_name = f'{data_name}_{mode}'
         pred_path = f'{self.abs_path}/{dir_name}/{eval_name}'
-        with open(pred_path, 'rb') as handle:
-            predictions = pickle.load(handle)
-        return predictions
+        
+        # predictions saved before the npz format are pickled dicts
+        if not os.path.isfile(f'{pred_path}.npz'):
+            with open(pred_path, 'rb') as handle:
+                predictions = pickle.load(handle)
+            return np.array(list(predictions.keys())), np.array(list(predictions.values()))
+            
+        with np.load(f'{pred_path}.npz') as data:
+            ids = data['ids']
+            is_logits = 'logits' in data.files
+            probs = data['logits' if is_logits else 'probs'].astype(np.float32)
+        
+        if is_logits and return_probs and probs.shape[-1] > 1:
+            probs = np.exp(probs - probs.max(axis=-1, keepdims=True))
+            probs /= probs.sum(axis=-1, keepdims=True)
+        return ids, probs
     
\ No newline at end of file
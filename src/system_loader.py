@@ -1,15 +1,22 @@
+import torch
 import torch.nn.functional as F
 import numpy as np
 import os
+import functools
 
 from tqdm import tqdm
 from typing import List
 
 from .trainer import Trainer
-from .utils.torch_utils import no_grad
+from .utils.torch_utils import no_grad_inference
 from .utils.data_utils import load_data
 from .helpers import DirHelper
-        
+
+@functools.lru_cache(maxsize=8)
+def _cached_load_data(data_name:str):
+    """ load_data shared across calls, the returned splits must not be mutated """
+    return load_data(data_name)
+
 class SystemLoader(Trainer):
     """Base loader class- the inherited class inherits
        the Trainer so has all experiment methods"""
@@ -27,58 +34,59 @@ class SystemLoader(Trainer):
         self.model.eval()
         self.device = 'cuda:0'
         self.to(self.device)
+        self.compile_model(mode='reduce-overhead')
 
     def load_preds(self, data_name:str, mode)->dict:
-        probs = self.load_probs(data_name, mode)
-        preds = {}
-        for k, probs in probs.items():
-            preds[k] = int(np.argmax(probs, axis=-1))  
-        return preds
+        # softmax doesn't change the argmax, so logits are enough here
+        ids, probs = self.load_probs_array(data_name, mode, return_probs=False)
+        if len(ids) == 0:
+            return {}
+        preds = probs.argmax(axis=-1)
+        return dict(zip(ids.tolist(), preds.tolist()))
         
-    def load_probs(self, data_name:str, mode)->dict:
+    def load_probs(self, data_name:str, mode, return_probs:bool=True)->dict:
         """loads predictions if saved, else generates"""
+        ids, probs = self.load_probs_array(data_name, mode, return_probs)
+        return dict(zip(ids.tolist(), probs))
+
+    def load_probs_array(self, data_name:str, mode, return_probs:bool=True):
+        """loads the ids and [N, C] predictions if saved, else generates"""
         if not self.dir.probs_exists(data_name, mode):
-            self.set_up_helpers()
-            self.generate_probs(data_name, mode)
-        probs = self.dir.load_probs(data_name, mode)
-        return probs
-
-    def generate_probs(self, data_name:str, mode):
-        probabilties = self._probs(data_name, mode)
-        self.dir.save_probs(probabilties, data_name, mode)
-
-    @no_grad
-    def _probs(self, data_name:str, mode='test'):
-        """get model predictions for given data"""
-        self.model.eval()
-        self.to(self.device)
+            if not hasattr(self, 'model'): self.set_up_helpers()
+            self.generate_probs(data_name, mode, return_probs)
+        return self.dir.load_probs_array(data_name, mode, return_probs=return_probs)
+
+    def generate_probs(self, data_name:str, mode, return_probs:bool=True):
+        probabilties = self._probs(data_name, mode, return_probs)
+        self.dir.save_probs(probabilties, data_name, mode, logits=not return_probs)
+
+    @no_grad_inference
+    def _probs(self, data_name:str, mode='test', return_probs:bool=True):
+        """get model predictions for given data (raw logits if not return_probs)"""
         eval_data = self.data_loader.get_data_split(data_name, mode)
-        eval_batches = self.batcher(data=eval_data, bsz=1, shuffle=False)
         
-        probabilties = {}
-        for batch in tqdm(eval_batches):
-            sample_id = batch.sample_id[0]
-            output = self.model_output(batch)
-
-            y = output.y.squeeze(0)
-            if y.shape and y.shape[-1] > 1:  # Get probabilities of predictions
-                y = F.softmax(y, dim=-1)
-            probabilties[sample_id] = y.cpu().numpy()
+        sample_ids, probs = [], []
+        with self.batcher.prefetch(data=eval_data, bsz=self.eval_bsz, shuffle=False, sort=True) as eval_batches:
+            for batch in tqdm(eval_batches):
+                output = self.model_output(batch)
+
+                y = output.y.float()
+                if return_probs and y.shape[-1] > 1:  # Get probabilities of predictions
+                    y = F.softmax(y, dim=-1)
+                sample_ids += batch.sample_id
+                probs.append(y.clone())  # cuda graph outputs (compiled model) get overwritten on replay
+        
+        if not sample_ids:
+            return {}
+        
+        # single device to host copy once all batches are done
+        probs = torch.cat(probs).cpu().numpy()
+        probabilties = dict(zip(sample_ids, probs))
         return probabilties
     
     @staticmethod
     def load_labels(data_name:str, mode='test')->dict:
-        split_index = {'train':0, 'dev':1, 'test':2}
-
-        if '_' not in mode:
-            eval_data = load_data(data_name)[split_index[mode]]
-        else:
-            splits = mode.split('_')
-            eval_data = []
-            for split in splits:
-                eval_data += load_data(data_name)[split_index[mode]]
-            
-        
+        eval_data = SystemLoader.get_eval_data(data_name, mode)
         
         labels_dict = {}
         for k, ex in enumerate(eval_data):
@@ -87,8 +95,7 @@ class SystemLoader(Trainer):
 
     @staticmethod
     def load_inputs(data_name:str, mode='test')->dict:
-        split_index = {'train':0, 'dev':1, 'test':2}
-        eval_data = load_data(data_name)[split_index[mode]]
+        eval_data = SystemLoader.get_eval_data(data_name, mode)
         
         inputs_dict = {}
         for k, ex in enumerate(eval_data):
@@ -97,13 +104,12 @@ class SystemLoader(Trainer):
     
     @staticmethod
     def get_eval_data(data_name:str, mode='test'):
-        if '_' not in mode:
-            eval_data = load_data(data_name)[split_index[mode]]
-        else:
-            splits = mode.split('_')
-            eval_data = []
-            for split in splits:
-                eval_data += load_data(data_name)[split_index[mode]]
+        split_index = {'train':0, 'dev':1, 'test':2}
+        data_splits = _cached_load_data(data_name)
+        
+        eval_data = []
+        for split in mode.split('_'):
+            eval_data += data_splits[split_index[split]]
         return eval_data
     
 class EnsembleLoader(SystemLoader):
@@ -112,19 +118,43 @@ class EnsembleLoader(SystemLoader):
         self.paths  = [f'{exp_path}/{seed}' for seed in os.listdir(exp_path) if os.path.isdir(f'{exp_path}/{seed}')]
         self.seeds  = [SystemLoader(seed_path) for seed_path in self.paths]
     
-    def load_probs(self, data_name:str, mode)->dict:
-        seed_probs = [seed.load_probs(data_name, mode) for seed in self.seeds]
+    def load_probs(self, data_name:str, mode, return_probs:bool=True)->dict:
+        # seeds are always averaged as probabilities, whatever return_probs is
+        seed_probs = []
+        for seed in self.seeds:
+            seed_probs.append(seed.load_probs(data_name, mode))
+            self.release_model(seed)
 
-        conv_ids = seed_probs[0].keys()
-        assert all([i.keys() == conv_ids for i in seed_probs])
+        conv_ids = list(seed_probs[0].keys())
+        assert all([i.keys() == seed_probs[0].keys() for i in seed_probs])
+        if not conv_ids:
+            return {}
 
-        ensemble = {}
-        for conv_id in conv_ids:
-            probs = [seed[conv_id] for seed in seed_probs]
-            probs = np.mean(probs, axis=0)
-            ensemble[conv_id] = probs
+        # stack seeds into a single [S, N, C] array and average in one call
+        probs = np.stack([np.stack([seed[k] for k in conv_ids]) for seed in seed_probs])
+        ensemble = dict(zip(conv_ids, probs.mean(axis=0)))
         return ensemble    
+
+    def load_preds(self, data_name:str, mode)->dict:
+        # ensemble probs only exist as a dict (no saved array), so stack them here
+        probs = self.load_probs(data_name, mode)
+        if not probs:
+            return {}
+        ids = list(probs.keys())
+        preds = np.stack([probs[k] for k in ids]).argmax(axis=-1)
+        return dict(zip(ids, preds.tolist()))
     
     def load_seed_preds(self, data_name:str, mode='test')->List[dict]:
-        return [seed.load_preds(data_name, mode) for seed in self.seeds]
+        seed_preds = []
+        for seed in self.seeds:
+            seed_preds.append(seed.load_preds(data_name, mode))
+            self.release_model(seed)
+        return seed_preds
+
+    @staticmethod
+    def release_model(seed:SystemLoader):
+        """frees a seed's model (if loaded) so models don't pile up on the gpu"""
+        if hasattr(seed, 'model'):
+            del seed.model
+            torch.cuda.empty_cache()
     
@@ -6,12 +6,13 @@ import pickle
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 
+from contextlib import nullcontext
 from collections import namedtuple
 from types import SimpleNamespace
 from typing import List, Tuple
 
 from .helpers import DataLoader, DirHelper, Batcher
-from .utils.torch_utils import no_grad
+from .utils.torch_utils import no_grad_inference, autocast, amp_dtype, adamw_kwargs
 from .models import select_model
 
 class Trainer():
@@ -27,7 +28,10 @@ class Trainer():
     def set_up_helpers(self, m_args:namedtuple):
         self.model_args = m_args
         self.data_loader = DataLoader(m_args.transformer)
-        self.batcher = Batcher(max_len=m_args.max_len)
+        self.compile = getattr(m_args, 'compile', False) and hasattr(torch.nn.Module, 'compile')
+        
+        # compiled graphs are specialised per shape, so lengths are padded to fixed buckets
+        self.batcher = Batcher(max_len=m_args.max_len, pad_multiple=64 if self.compile else None)
         
         #temp routing for backward compatibility
         if hasattr(m_args, 'num_classes'):
@@ -36,6 +40,13 @@ class Trainer():
             self.model = select_model(model_name=m_args.transformer)
 
         self.device = m_args.device
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # benchmarking only pays off when shapes repeat, i.e. lengths are bucketed
+        torch.backends.cudnn.benchmark = self.batcher.pad_multiple is not None
+        self.eval_bsz = getattr(m_args, 'eval_bsz', 32)
+        self.amp = getattr(m_args, 'amp', False)
+        self.amp_dtype = amp_dtype() if self.amp else None
                  
     def train(self, args:namedtuple):
         self.dir.save_args('train_args.json', args)
@@ -43,33 +54,53 @@ class Trainer():
  
         train, dev, test = self.data_loader(args.data_set, args.lim)
         
-        optimizer = torch.optim.AdamW(self.model.parameters(), lr=args.lr)
-        best_epoch = (-1, 10000, 0)
+        # model moved first, as fused AdamW requires the parameters on device
         self.to(self.device)
+        parameters = list(self.model.parameters())
+        optimizer = torch.optim.AdamW(parameters, lr=args.lr, **adamw_kwargs(parameters))
+        scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype==torch.float16)
+        accum_steps = getattr(args, 'accum_steps', 1)
+        assert accum_steps >= 1, 'accum_steps must be at least 1'
+        best_epoch = (-1, 10000, 0)
+        self.compile_model(mode='max-autotune')
         
         for epoch in range(args.epochs):
             ######  TRAINING  ##############################
             self.model.train()
             self.dir.reset_metrics()
-            train_b = self.batcher(data=train, bsz=args.bsz, shuffle=True)
-            
-            for k, batch in enumerate(train_b, start=1):
-                output = self.model_output(batch)
-
-                optimizer.zero_grad()
-                output.loss.backward()
-                optimizer.step()
-
-                # accuracy logging
-                self.dir.update_avg_metrics(loss=output.loss)
-                self.dir.update_acc_metrics(hits=output.hits, 
-                                            num_preds=output.num_preds)
+            optimizer.zero_grad(set_to_none=True)
+            k = 0
+            with self.batcher.prefetch(data=train, bsz=args.bsz, shuffle=True) as train_b:
+                for k, batch in enumerate(train_b, start=1):
+                    output = self.model_output(batch)
+
+                    # gradients are accumulated over accum_steps batches per update
+                    scaler.scale(output.loss/accum_steps).backward()
+                    if k%accum_steps == 0:
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad(set_to_none=True)
+
+                    # accuracy logging
+                    self.dir.update_avg_metrics(loss=output.loss.detach())
+                    self.dir.update_acc_metrics(hits=output.hits, 
+                                                num_preds=output.num_preds)
                 
-                # print train performance every now and then
-                if k%args.print_len == 0:
-                    perf = self.dir.print_perf('train', epoch, k)
-                    if args.wandb:
-                         wandb.log({'epoch':epoch, 'loss':perf.loss, 'acc':perf.acc})
+                    # print train performance every now and then
+                    if k%args.print_len == 0:
+                        perf = self.dir.print_perf('train', epoch, k)
+                        if args.wandb:
+                             wandb.log({'epoch':epoch, 'loss':perf.loss, 'acc':perf.acc})
+            
+            # update with any gradients left over from the last batches, rescaled
+            # so they are averaged over the leftover batches, not accum_steps
+            leftover = k%accum_steps
+            if leftover:
+                for param in self.model.parameters():
+                    if param.grad is not None: param.grad.mul_(accum_steps/leftover)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
             
             ######  DEV  ##################################
             self.model.eval()
@@ -96,67 +127,77 @@ class Trainer():
         if getattr(self, 'bias', False):
             return self.bias_model_output(batch)
              
-        output = self.model(input_ids=batch.ids, 
-                            attention_mask=batch.mask)
+        with autocast(self.amp_dtype) if self.amp else nullcontext():
+            output = self.model(input_ids=batch.ids, 
+                                attention_mask=batch.mask)
                 
-        loss = F.cross_entropy(output.y, batch.labels)
+            loss = F.cross_entropy(output.y, batch.labels)
         
-        # return accuracy metrics
-        hits = torch.argmax(output.y, dim=-1) == batch.labels
-        hits = torch.sum(hits[batch.labels != -100]).item()
-        num_preds = torch.sum(batch.labels != -100).item()
+        # return accuracy metrics (kept on device to avoid syncing every step)
+        valid = batch.labels != -100
+        hits = ((torch.argmax(output.y, dim=-1) == batch.labels) & valid).sum()
+        num_preds = valid.sum()
 
         return SimpleNamespace(loss=loss, y=output.y, h=output.h,
                                hits=hits, num_preds=num_preds)
 
     ############# EVAL METHODS ####################################
-    @no_grad
+    @no_grad_inference
     def system_eval(self, data, epoch:int, mode='dev'):
         self.dir.reset_metrics()         
-        batches = self.batcher(data=data, bsz=1, shuffle=False)
-        for k, batch in enumerate(batches, start=1):
-            output = self.model_output(batch)
-            self.dir.update_avg_metrics(loss=output.loss)
-            self.dir.update_acc_metrics(hits=output.hits, 
-                                        num_preds=output.num_preds)
+        with self.batcher.prefetch(data=data, bsz=self.eval_bsz, shuffle=False, sort=True) as batches:
+            for k, batch in enumerate(batches, start=1):
+                output = self.model_output(batch)
+                self.dir.update_avg_metrics(n=len(batch.sample_id), loss=output.loss)
+                self.dir.update_acc_metrics(hits=output.hits, 
+                                            num_preds=output.num_preds)
         perf = self.dir.print_perf(mode, epoch, 0)
         return perf
 
-    def generate_probs(self, data:list, data_name:str):
-        probabilties = self._probs(data)
-        self.dir.save_probs(probabilties, data_name, mode='test')
-
-    @no_grad
-    def _probs(self, data):
-        """get model predictions for given data"""
-        self.model.eval()
-        self.to(self.device)
-        eval_batches = self.batcher(data=data, bsz=1, shuffle=False)
+    def generate_probs(self, data:list, data_name:str, return_probs:bool=True):
+        probabilties = self._probs(data, return_probs)
+        self.dir.save_probs(probabilties, data_name, mode='test', logits=not return_probs)
 
-        probabilties = {}
-        for batch in eval_batches:
-            sample_id = batch.sample_id[0]
-            output = self.model_output(batch)
+    @no_grad_inference
+    def _probs(self, data, return_probs:bool=True):
+        """get model predictions for given data (raw logits if not return_probs)"""
+        sample_ids, probs = [], []
+        with self.batcher.prefetch(data=data, bsz=self.eval_bsz, shuffle=False, sort=True) as eval_batches:
+            for batch in eval_batches:
+                output = self.model_output(batch)
 
-            y = output.y.squeeze(0)
-            if y.shape and y.shape[-1] > 1:  # Get probabilities of predictions
-                y = F.softmax(y, dim=-1)
-            probabilties[sample_id] = y.cpu().numpy()
+                y = output.y.float()
+                if return_probs and y.shape[-1] > 1:  # Get probabilities of predictions
+                    y = F.softmax(y, dim=-1)
+                sample_ids += batch.sample_id
+                probs.append(y.clone())  # cuda graph outputs (compiled model) get overwritten on replay
+        
+        if not sample_ids:
+            return {}
+        
+        # single device to host copy once all batches are done
+        probs = torch.cat(probs).cpu().numpy()
+        probabilties = dict(zip(sample_ids, probs))
         return probabilties
     
     #############  MODEL UTILS  ###################################
     
     def save_model(self, name:str='base'):
-        device = next(self.model.parameters()).device
-        self.model.to("cpu")
-        torch.save(self.model.state_dict(), 
-                   f'{self.dir.abs_path}/models/{name}.pt')
-        self.model.to(self.device)
+        # copies only the weights to cpu, the model itself stays on device
+        state_dict = {k: v.detach().cpu() for k, v in self.model.state_dict().items()}
+        torch.save(state_dict, f'{self.dir.abs_path}/models/{name}.pt')
 
     def load_model(self, name:str='base'):
         self.model.load_state_dict(
             torch.load(self.dir.abs_path + f'/models/{name}.pt'))
 
+    def compile_model(self, mode:str):
+        """compiles the model in place (keeps state_dict keys), if enabled"""
+        if self.compile:
+            # one static graph per length bucket and batch size (incl. last batches)
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            self.model.compile(mode=mode, dynamic=False)
+
     def to(self, device):
         assert hasattr(self, 'model') and hasattr(self, 'batcher')
         self.model.to(device)
@@ -1,4 +1,5 @@
 import torch
+import inspect
 from typing import Callable
 from transformers import BertModel, ElectraModel, RobertaModel, DistilBertModel, BertConfig
 from transformers import BertTokenizerFast, ElectraTokenizerFast, RobertaTokenizerFast, DistilBertTokenizerFast
@@ -23,22 +24,60 @@ def load_tokenizer(system:str)->'Tokenizer':
 
 def load_transformer(system:str)->'Model':
     """ downloads and returns the relevant pretrained transformer from huggingface """
-    if   system == 'bert'       : trans_model = BertModel.from_pretrained('bert-base-uncased', return_dict=True)
+    if   system == 'bert'       : trans_model = from_pretrained(BertModel, 'bert-base-uncased', return_dict=True)
     elif system == 'bert_rand'  : trans_model = BertModel(BertConfig())
-    elif system == 'bert_cased' : trans_model = BertModel.from_pretrained('bert-base-cased', return_dict=True)
-    elif system == 'bert_large' : trans_model = BertModel.from_pretrained('bert-large-uncased', return_dict=True)
-    elif system == 'bert_tiny'  : trans_model = AutoModel.from_pretrained("prajjwal1/bert-tiny")
-    elif system == 'dist_bert'  : trans_model = DistilBertModel.from_pretrained("distilbert-base-uncased", return_dict=True)
-    elif system == 'roberta'    : trans_model = RobertaModel.from_pretrained('roberta-base', return_dict=True)
-    elif system == 'electra'    : trans_model = ElectraModel.from_pretrained('google/electra-base-discriminator',return_dict=True)
+    elif system == 'bert_cased' : trans_model = from_pretrained(BertModel, 'bert-base-cased', return_dict=True)
+    elif system == 'bert_large' : trans_model = from_pretrained(BertModel, 'bert-large-uncased', return_dict=True)
+    elif system == 'bert_tiny'  : trans_model = from_pretrained(AutoModel, "prajjwal1/bert-tiny")
+    elif system == 'dist_bert'  : trans_model = from_pretrained(DistilBertModel, "distilbert-base-uncased", return_dict=True)
+    elif system == 'roberta'    : trans_model = from_pretrained(RobertaModel, 'roberta-base', return_dict=True)
+    elif system == 'electra'    : trans_model = from_pretrained(ElectraModel, 'google/electra-base-discriminator',return_dict=True)
     elif system == 'electra_large':
-        trans_model= ElectraModel.from_pretrained('google/electra-large-discriminator', return_dict=True)
+        trans_model= from_pretrained(ElectraModel, 'google/electra-large-discriminator', return_dict=True)
     else: raise ValueError("invalid transfomer system provided")
     return trans_model
 
+def from_pretrained(model_cls, name:str, **kwargs)->'Model':
+    """ loads with torch's fused scaled_dot_product_attention, falling back 
+        to the default attention where transformers/the model doesn't support it """
+    try:
+        return model_cls.from_pretrained(name, attn_implementation='sdpa', **kwargs)
+    except (TypeError, ValueError, ImportError):
+        return model_cls.from_pretrained(name, **kwargs)
+
 def no_grad(func:Callable)->Callable:
     """ decorator which detaches gradients """
     def inner(*args, **kwargs):
         with torch.no_grad():
             return func(*args, **kwargs)
     return inner
+
+def no_grad_inference(func:Callable)->Callable:
+    """ decorator which runs in inference mode (no_grad for older torch) """
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    def inner(*args, **kwargs):
+        with inference_mode():
+            return func(*args, **kwargs)
+    return inner
+
+def adamw_kwargs(parameters:list)->dict:
+    """ selects the fastest AdamW implementation the installed torch offers
+        (fused only when every parameter is already on a cuda device) """
+    options = inspect.signature(torch.optim.AdamW).parameters
+    if 'fused' in options and all(p.is_cuda for p in parameters):
+        return {'fused':True}
+    if 'foreach' in options:
+        return {'foreach':True}
+    return {}
+
+def amp_dtype()->torch.dtype:
+    """ half precision type for autocast, bf16 where the gpu supports it """
+    if torch.cuda.is_available() and getattr(torch.cuda, 'is_bf16_supported', lambda: False)():
+        return torch.bfloat16
+    return torch.float16
+
+def autocast(dtype:torch.dtype):
+    """ mixed precision context manager (falls back to fp16 for older torch) """
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type='cuda', dtype=dtype)
+    return torch.cuda.amp.autocast()